@@ -0,0 +1 @@
+DROP FUNCTION topup_subscriber(varchar, numeric, numeric);
@@ -0,0 +1,28 @@
+-- Apply a data topup to a subscriber and record the new state in the history
+-- table, all server-side so a topup costs a single round trip. The topup is
+-- only applied if the subscriber's balance still matches the expected balance,
+-- so callers can confirm a topup without holding a lock while they wait. No
+-- row is returned if the subscriber does not exist or the balance changed.
+CREATE FUNCTION topup_subscriber(p_imsi varchar, p_delta numeric, p_expected_data_balance numeric)
+RETURNS TABLE("old_data_balance" bigint, "new_data_balance" bigint)
+LANGUAGE plpgsql
+AS $$
+DECLARE
+  sub subscribers%ROWTYPE;
+BEGIN
+  UPDATE subscribers
+  SET data_balance = data_balance + p_delta
+  WHERE imsi = p_imsi AND data_balance = p_expected_data_balance
+  RETURNING * INTO sub;
+  IF NOT FOUND THEN
+    RETURN;
+  END IF;
+
+  INSERT INTO subscriber_history("subscriber", "time", "data_balance", "balance", "bridged")
+  VALUES (sub.internal_uid, CURRENT_TIMESTAMP, sub.data_balance, sub.balance, sub.bridged);
+
+  old_data_balance := p_expected_data_balance;
+  new_data_balance := sub.data_balance;
+  RETURN NEXT;
+END
+$$;
@@ -10,6 +10,7 @@ assumes the host system has python3 and has access to git on the user PATH.
 from pathlib import Path
 
 import argparse
+import concurrent.futures
 import logging
 import os
 import shutil
@@ -27,15 +28,31 @@ def _setup_workspace(workspace_path):
 
 
 def _build_docker_image(base_build_path, dockerfile, image_tag):
-    subprocess.run(
-        ["docker", "build", "-f", dockerfile, "--tag", image_tag, base_build_path]
+    # BuildKit on the default driver keeps its layer cache in the docker
+    # daemon, so rebuilds reuse layers without exporting or reloading images.
+    return subprocess.run(
+        [
+            "docker",
+            "build",
+            "--progress=plain",
+            "-f",
+            dockerfile,
+            "--tag",
+            image_tag,
+            base_build_path,
+        ],
+        env=dict(os.environ, DOCKER_BUILDKIT="1"),
+        stdout=subprocess.PIPE,
+        stderr=subprocess.STDOUT,
+        universal_newlines=True,
+        check=True,
     )
 
 
 def _run_dockerized_build(workspace_path, image_tag):
     host_bind_path = workspace_path.joinpath("build").resolve()
 
-    subprocess.run(
+    return subprocess.run(
         [
             "docker",
             "run",
@@ -43,25 +60,68 @@ def _run_dockerized_build(workspace_path, image_tag):
             "{}:/build-volume".format(str(host_bind_path)),
             image_tag,
             str(os.getuid()),
-        ]
+        ],
+        stdout=subprocess.PIPE,
+        stderr=subprocess.STDOUT,
+        universal_newlines=True,
+        check=True,
     )
 
 
+def _print_prefixed(prefix, output):
+    for line in output.splitlines():
+        print("[{}] {}".format(prefix, line))
+
+
+def _build_and_run(workspace_path, distro):
+    """Build the image for a single distribution and run the build within it.
+
+    Output is captured and printed once each step completes so that logs from
+    concurrent builds are not interleaved.
+    """
+    image_name = "haulage/{}-build-local".format(distro)
+    try:
+        result = _build_docker_image(
+            workspace_path,
+            Path("pkg/crossplatform/Dockerfile-{}".format(distro)),
+            image_tag=image_name,
+        )
+        _print_prefixed(distro, result.stdout)
+
+        result = _run_dockerized_build(workspace_path, image_tag=image_name)
+        _print_prefixed(distro, result.stdout)
+    except subprocess.CalledProcessError as e:
+        _print_prefixed(distro, e.output)
+        raise
+
+
 def main(workspace_path):
     parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "-j",
+        "--jobs",
+        type=int,
+        default=len(DISTRIBUTIONS),
+        help="The number of distributions to build concurrently",
+    )
     args = parser.parse_args()
     log.debug("Parsed args {}".format(args))
 
     _setup_workspace(workspace_path)
 
-    for distro in DISTRIBUTIONS:
-        image_name = "haulage/{}-build-local".format(distro)
-        _build_docker_image(
-            workspace_path,
-            Path("pkg/crossplatform/Dockerfile-{}".format(distro)),
-            image_tag=image_name,
-        )
-        _run_dockerized_build(workspace_path, image_tag=image_name)
+    with concurrent.futures.ThreadPoolExecutor(max_workers=args.jobs) as executor:
+        futures = [
+            executor.submit(_build_and_run, workspace_path, distro)
+            for distro in DISTRIBUTIONS
+        ]
+        for future in concurrent.futures.as_completed(futures):
+            try:
+                future.result()
+            except subprocess.CalledProcessError:
+                # Don't start any builds still waiting for a worker.
+                for pending in futures:
+                    pending.cancel()
+                raise
 
 
 if __name__ == "__main__":
@@ -1,175 +1,224 @@
 #!/usr/bin/env python3
 
+import csv
 import sys
 import decimal
-import yaml
+import shlex
 
-import psycopg2
+#########################################################################
+############### SETUP: LOAD YAML VARS AND CONNECT TO DB #################
+#########################################################################
+db = None
+cursor = None
+
+
+def open_db():
+    """Connect to the database on first use and return the shared cursor.
+
+    The config file and database driver are only loaded here, so help and
+    argument errors exit without paying for either.
+    """
+    global db, cursor
+    if db is not None:
+        return cursor
+
+    import psycopg2
+    import yaml
+
+    # Prefer the libyaml backed loader when available, it is much faster than
+    # the pure python implementation.
+    try:
+        from yaml import CSafeLoader as SafeLoader
+    except ImportError:
+        from yaml import SafeLoader
+
+    with open("/etc/haulage/config.yml") as f:
+        conf = yaml.load(f, Loader=SafeLoader)
+        dbname = conf["custom"]["dbLocation"]
+        db_user = conf["custom"]["dbUser"]
+        db_pass = conf["custom"]["dbPass"]
+
+    db = psycopg2.connect(
+        host="localhost", user=db_user, password=db_pass, dbname=dbname
+    )
+    # Each command is a single statement, so let the server wrap each one in
+    # its own implicit transaction rather than paying for explicit
+    # BEGIN/COMMIT.
+    db.set_session(autocommit=True)
+    cursor = db.cursor()
+    return cursor
 
 
 def display_help():
     print("COMMANDS:")
     print("   add {imsi msisdn ip [currency_code]}: adds a user to the network")
+    print(
+        "   add-batch {csv_file}: adds every user in a csv file with rows of imsi,msisdn,ip[,currency_code]"
+    )
     print("   remove {imsi}: removes a user from the network")
     print("   topup {imsi} {bytes}: adds bytes to a user's account")
+    print(
+        "   batch: reads one command per line from stdin and runs them all over a single connection, topups are applied without confirmation"
+    )
     print("   help: displays this message and exits")
 
 
-#########################################################################
-############### SETUP: LOAD YAML VARS AND CONNECT TO DB #################
-#########################################################################
-print("haulagedb: Haulage Database Configuration Tool")
-
-if len(sys.argv) <= 1:
-    display_help()
-    exit(0)
-
-command = sys.argv[1]
-
-if command == "help":
-    display_help()
-    exit(0)
-
-with open("/etc/haulage/config.yml") as f:
-    conf = yaml.load(f, Loader=yaml.SafeLoader)
-    dbname = conf["custom"]["dbLocation"]
-    db_user = conf["custom"]["dbUser"]
-    db_pass = conf["custom"]["dbPass"]
-
-db = psycopg2.connect(host="localhost", user=db_user, password=db_pass, dbname=dbname)
-cursor = db.cursor()
-
 #########################################################################
 ############### OPTION ONE: ADD A USER TO THE DATABASE ##################
 #########################################################################
-if command == "add":
-    if (len(sys.argv) < 5) or (len(sys.argv) > 6):
+def add_user(args):
+    if (len(args) < 4) or (len(args) > 5):
         print(
             'haulagedb: incorrect number of args, format is "haulagedb add imsi msisdn ip [currency_code]"'
         )
         exit(1)
 
-    imsi = sys.argv[2]
-    msisdn = sys.argv[3]
-    ip = sys.argv[4]
+    imsi = args[1]
+    msisdn = args[2]
+    ip = args[3]
 
-    if len(sys.argv) > 5:
-        currency = sys.argv[5]
+    if len(args) > 4:
+        currency = args[4]
     else:
         currency = "IDR"
 
     # TODO: error-handling? Check if imsi/msisdn/ip already in system?
     print("haulagedb: adding user " + str(imsi))
 
-    cursor.execute("BEGIN TRANSACTION")
+    cursor = open_db()
 
+    # Resolve the currency and insert both the subscriber and its static ip
+    # in a single statement. Foreign keys are checked at the end of the
+    # statement, so the static ip may reference the new subscriber.
     cursor.execute(
         """
-        SELECT id FROM currencies WHERE code=%s
+        WITH new_subscriber AS (
+            INSERT INTO subscribers (imsi, currency)
+            SELECT %s, id FROM currencies WHERE code=%s
+            RETURNING imsi
+        )
+        INSERT INTO static_ips (imsi, ip)
+        SELECT imsi, %s::inet FROM new_subscriber
+        RETURNING imsi
         """,
-        [currency],
+        [imsi, currency, ip],
     )
-    currency_ids = cursor.fetchall()
-    if len(currency_ids) != 1:
+    if len(cursor.fetchall()) != 1:
         raise RuntimeError(
             "Invalid currency code {}, try one like IDR or USD".format(currency)
         )
 
+
+def add_user_batch(args):
+    if len(args) != 2:
+        print(
+            'haulagedb: incorrect number of args, format is "haulagedb add-batch csv_file"'
+        )
+        exit(1)
+
+    users = []
+    with open(args[1], newline="") as f:
+        for row in csv.reader(f):
+            if len(row) == 0:
+                continue
+            if (len(row) < 3) or (len(row) > 4):
+                print(
+                    "haulagedb: invalid row {}, format is imsi,msisdn,ip[,currency_code]".format(
+                        row
+                    )
+                )
+                exit(1)
+            if len(row) == 3:
+                row.append("IDR")
+            users.append(row)
+
+    print("haulagedb: adding " + str(len(users)) + " users from " + args[1])
+
+    import psycopg2.extras
+
+    cursor = open_db()
+
+    # Resolve every currency code in the file with one query, so unknown codes
+    # are rejected before anything is inserted.
+    currency_codes = list(set(user[3] for user in users))
     cursor.execute(
+        """
+        SELECT code, id FROM currencies WHERE code = ANY(%s)
+        """,
+        [currency_codes],
+    )
+    currency_ids = dict(cursor.fetchall())
+    for code in currency_codes:
+        if code not in currency_ids:
+            raise RuntimeError(
+                "Invalid currency code {}, try one like IDR or USD".format(code)
+            )
+
+    # Insert all users with multi-row inserts in a single transaction, so the
+    # whole file is added or none of it is.
+    db.autocommit = False
+
+    psycopg2.extras.execute_values(
+        cursor,
         """
         INSERT INTO subscribers (imsi, currency)
-        VALUES
-        (%s, %s)
+        VALUES %s
         """,
-        [imsi, currency_ids[0][0]],
+        [(user[0], currency_ids[user[3]]) for user in users],
+        page_size=1000,
     )
 
-    commit_str = (
-        "INSERT INTO static_ips (imsi, ip) VALUES ('" + imsi + "', '" + ip + "')"
+    psycopg2.extras.execute_values(
+        cursor,
+        """
+        INSERT INTO static_ips (imsi, ip)
+        VALUES %s
+        """,
+        [(user[0], user[2]) for user in users],
+        page_size=1000,
     )
-    cursor.execute(commit_str)
 
-    cursor.execute("COMMIT")
+    db.commit()
+    db.autocommit = True
+
 
 #########################################################################
 ############### OPTION TWO: REMOVE USER FROM THE DATABASE ###############
 #########################################################################
-elif command == "remove":
-    if len(sys.argv) != 3:
+def remove_user(args):
+    if len(args) != 2:
         print('haulagedb: incorrect number of args, format is "haulagedb remove imsi"')
         exit(1)
 
-    imsi = sys.argv[2]
+    imsi = args[1]
 
     print("haulagedb: removing user " + str(imsi))
 
-    cursor.execute("BEGIN TRANSACTION")
+    cursor = open_db()
 
     cursor.execute(
         """
-        DELETE FROM static_ips
-        WHERE imsi=%s
-        """,
-        [imsi],
-    )
-
-    cursor.execute(
-        """
-        DELETE FROM subscriber_history
-        WHERE subscriber IN (
-            SELECT internal_uid
-            FROM subscribers
+        WITH removed_ips AS (
+            DELETE FROM static_ips
             WHERE imsi=%s
+        ), removed_history AS (
+            DELETE FROM subscriber_history
+            WHERE subscriber IN (
+                SELECT internal_uid
+                FROM subscribers
+                WHERE imsi=%s
+            )
         )
-        """,
-        [imsi],
-    )
-
-    cursor.execute(
-        """
         DELETE FROM subscribers WHERE imsi=%s
         """,
-        [imsi],
+        [imsi, imsi, imsi],
     )
 
-    cursor.execute("COMMIT")
 
 #########################################################################
 ############### OPTION THREE: TOPUP (ADD BALANCE TO USER) ###############
 #########################################################################
-elif command == "topup":
-    if len(sys.argv) != 4:
-        print(
-            'haulagedb: incorrect number of args, format is "haulagedb topup imsi bytes"'
-        )
-        exit(1)
-
-    imsi = sys.argv[2]
-    amount = decimal.Decimal(sys.argv[3])
-    old_balance = 0
-    new_balance = 0
-
-    cursor.execute("BEGIN TRANSACTION")
-
-    # STEP ONE: query information
-    numrows = cursor.execute(
-        """
-        SELECT data_balance, internal_uid
-        FROM subscribers
-        WHERE imsi=%s
-        FOR UPDATE
-        """,
-        [imsi],
-    )
-    if numrows == 0:
-        print("haulagedb error: imsi " + str(imsi) + " does not exist!")
-        exit()
-
-    for row in cursor:
-        old_balance = decimal.Decimal(row[0])
-        new_balance = amount + old_balance
-
-    # STEP TWO: prompt for confirmation
+def confirm_topup(imsi, amount, old_balance, new_balance):
     promptstr = (
         "haulagedb: topup user "
         + str(imsi)
@@ -184,49 +233,148 @@ elif command == "topup":
     while True:
         answer = input(promptstr)
         if answer == "y" or answer == "Y" or answer == "":
-            print(
-                "haulagedb: updating user "
-                + str(imsi)
-                + " setting new data_balance to "
-                + str(new_balance)
-            )
-            cursor.execute(
-                """
-                UPDATE subscribers
-                SET data_balance = %s
-                WHERE imsi = %s
-                RETURNING internal_uid, data_balance, balance, bridged
-                """,
-                [new_balance, imsi],
-            )
-            new_sub_state = cursor.fetchall()
-            if len(new_sub_state) != 1:
-                raise RuntimeError("Database state invalid, too many records updated")
-            new_sub_state = new_sub_state[0]
-            cursor.execute(
-                """
-                INSERT INTO subscriber_history(subscriber, time, data_balance, balance, bridged)
-                VALUES
-                (%s, CURRENT_TIMESTAMP, %s, %s, %s)
-                """,
-                [
-                    new_sub_state[0],
-                    new_sub_state[1],
-                    new_sub_state[2],
-                    new_sub_state[3],
-                ],
-            )
-            cursor.execute("COMMIT")
-            break
+            return True
         if answer == "n" or answer == "N":
-            cursor.execute("ROLLBACK")
+            return False
+
+
+def topup_user(args, confirm=True):
+    if len(args) != 3:
+        print(
+            'haulagedb: incorrect number of args, format is "haulagedb topup imsi bytes"'
+        )
+        exit(1)
+
+    imsi = args[1]
+    amount = decimal.Decimal(args[2])
+
+    cursor = open_db()
+
+    while True:
+        # STEP ONE: query information
+        cursor.execute(
+            """
+            SELECT data_balance
+            FROM subscribers
+            WHERE imsi=%s
+            """,
+            [imsi],
+        )
+        row = cursor.fetchone()
+        if row is None:
+            print("haulagedb error: imsi " + str(imsi) + " does not exist!")
+            exit(1)
+
+        # The new balance is only computed for display, the topup itself is
+        # applied server-side by topup_subscriber.
+        old_balance = row[0]
+        new_balance = amount + old_balance
+
+        # STEP TWO: prompt for confirmation, without holding any locks
+        if confirm and not confirm_topup(imsi, amount, old_balance, new_balance):
             print("haulagedb: cancelling topup operation\n")
-            break
+            return
 
-else:
+        # STEP THREE: apply the topup, only if the balance still matches what
+        # was confirmed. The topup_subscriber database function applies the
+        # delta and records the history entry server-side in one round trip.
+        print(
+            "haulagedb: updating user "
+            + str(imsi)
+            + " setting new data_balance to "
+            + str(new_balance)
+        )
+        cursor.execute(
+            """
+            SELECT new_data_balance FROM topup_subscriber(%s, %s, %s)
+            """,
+            [imsi, amount, old_balance],
+        )
+        new_sub_state = cursor.fetchall()
+        if len(new_sub_state) > 1:
+            raise RuntimeError("Database state invalid, too many records updated")
+        if len(new_sub_state) == 1:
+            return
+
+        print(
+            "haulagedb: balance of user "
+            + str(imsi)
+            + " changed during the topup, retrying"
+        )
+
+
+# The commands which may appear on a line of batch input.
+BATCH_COMMANDS = ["add", "add-batch", "remove", "topup"]
+
+
+def run_command(args, confirm=True):
+    command = args[0]
+
+    if command == "add":
+        add_user(args)
+    elif command == "add-batch":
+        add_user_batch(args)
+    elif command == "remove":
+        remove_user(args)
+    elif command == "topup":
+        topup_user(args, confirm=confirm)
+    else:
+        display_help()
+        exit(0)
+
+
+print("haulagedb: Haulage Database Configuration Tool")
+
+if len(sys.argv) <= 1:
+    display_help()
+    exit(0)
+
+command = sys.argv[1]
+
+if command == "help":
     display_help()
     exit(0)
 
-db.commit()
-cursor.close()
-db.close()
+if command == "batch":
+    # Run many commands over the one connection, so scripted provisioning
+    # pays for process startup, config parsing and connecting only once.
+    # Any bad line stops the batch with a non-zero exit status, reporting the
+    # line so the remaining input can be fixed up and re-run.
+    for line_number, line in enumerate(sys.stdin, start=1):
+        try:
+            args = shlex.split(line, comments=True)
+        except ValueError as e:
+            print("haulagedb: batch line {}: {}".format(line_number, e))
+            exit(1)
+        if len(args) == 0:
+            continue
+        if args[0] not in BATCH_COMMANDS:
+            print(
+                "haulagedb: batch line {}: unknown command {}".format(
+                    line_number, args[0]
+                )
+            )
+            exit(1)
+
+        try:
+            run_command(args, confirm=False)
+        except SystemExit:
+            print(
+                "haulagedb: batch stopped at line {}: {}".format(
+                    line_number, line.strip()
+                )
+            )
+            exit(1)
+        except Exception:
+            print(
+                "haulagedb: batch stopped at line {}: {}".format(
+                    line_number, line.strip()
+                )
+            )
+            raise
+else:
+    run_command(sys.argv[1:])
+
+if db is not None:
+    cursor.close()
+    db.close()
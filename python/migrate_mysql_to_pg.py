@@ -1,21 +1,30 @@
 #!/usr/bin/env python3
 
 import argparse
+import concurrent.futures
+import io
 import logging
 
 from pathlib import Path
 
 import mysql.connector
 import psycopg2
-import psycopg2.errors
+import psycopg2.extras
 import yaml
 
-logging.basicConfig(level=logging.DEBUG)
+# Prefer the libyaml backed loader when available, it is much faster than the
+# pure python implementation.
+try:
+    from yaml import CSafeLoader as SafeLoader
+except ImportError:
+    from yaml import SafeLoader
+
+MIGRATION_BATCH_SIZE = 10000
 
 
 def read_haulage_config(config_path):
     with open(config_path) as f:
-        config_file = yaml.load(f, Loader=yaml.SafeLoader)
+        config_file = yaml.load(f, Loader=SafeLoader)
         try:
             db_name = config_file["custom"]["dbLocation"]
             db_user = config_file["custom"]["dbUser"]
@@ -52,20 +61,12 @@ def canonicalize_currency(code, symbol, name, pg_conn):
             INSERT INTO currencies("name", "code", "symbol")
             VALUES
             (%s, %s, %s)
+            RETURNING id
             """,
             [name, code, symbol],
         )
-
-        cursor.execute(
-            """
-            SELECT id, name, code, symbol
-            FROM currencies
-            WHERE code=%s;
-            """,
-            [code],
-        )
         inserted_id = cursor.fetchall()
-        if len(inserted_id != 1):
+        if len(inserted_id) != 1:
             raise RuntimeError(
                 "The just inserted currency code didn't match exactly one row, which should never happen."
             )
@@ -96,44 +97,107 @@ def canonicalize_currency(code, symbol, name, pg_conn):
         )
 
 
+def _fetch_batches(mysql_cursor):
+    """Yield batches of rows from a cursor with an executed query.
+
+    The next batch is fetched on a worker thread while the caller writes the
+    current one, so reading from mysql overlaps with writing to postgres.
+    """
+    with concurrent.futures.ThreadPoolExecutor(max_workers=1) as executor:
+        next_rows = executor.submit(mysql_cursor.fetchmany, MIGRATION_BATCH_SIZE)
+        while True:
+            rows = next_rows.result()
+            if len(rows) == 0:
+                return
+            next_rows = executor.submit(mysql_cursor.fetchmany, MIGRATION_BATCH_SIZE)
+            yield rows
+
+
+def _copy_text_row(values):
+    """Format a row of values as a line of postgres COPY text format."""
+    fields = []
+    for value in values:
+        if value is None:
+            fields.append("\\N")
+        else:
+            fields.append(
+                str(value)
+                .replace("\\", "\\\\")
+                .replace("\t", "\\t")
+                .replace("\n", "\\n")
+                .replace("\r", "\\r")
+            )
+    return "\t".join(fields) + "\n"
+
+
 def migrate_subscribers(mysql_conn, pg_conn, currency_id):
     mysql_conn.start_transaction(isolation_level="SERIALIZABLE")
-    mysql_cursor = mysql_conn.cursor()
+    # Use an unbuffered cursor so rows are streamed from the server as they
+    # are fetched rather than read into memory all at once.
+    mysql_cursor = mysql_conn.cursor(buffered=False)
     pg_cursor = pg_conn.cursor()
 
+    # Stream the legacy rows into a staging table with COPY, then move them
+    # into subscribers with a single insert that skips existing subscribers.
+    pg_cursor.execute(
+        """
+        CREATE TEMPORARY TABLE subscribers_import (
+            "imsi" varchar(16),
+            "data_balance" bigint,
+            "balance" decimal(13,4),
+            "currency" smallint,
+            "bridged" boolean
+        ) ON COMMIT DROP
+        """
+    )
+
     mysql_cursor.execute(
         "select imsi, username, raw_down, raw_up, data_balance, balance, bridged, enabled, admin, msisdn from customers;"
     )
-    for row in mysql_cursor:
-        if row[6] == 1:
-            bridged = True
-        else:
-            bridged = False
-
-        new_sub_row = [row[0], row[4], row[5], currency_id, bridged]
+    # Checked once up front since per-row logging is skipped entirely unless
+    # debug output was requested.
+    log_rows = logging.getLogger().isEnabledFor(logging.DEBUG)
+    row_count = 0
+    for rows in _fetch_batches(mysql_cursor):
+        buffer = io.StringIO()
+        for row in rows:
+            if row[6] == 1:
+                bridged = True
+            else:
+                bridged = False
+
+            new_sub_row = [row[0], row[4], row[5], currency_id, bridged]
+            if log_rows:
+                logging.debug(
+                    "Migrating customer -> subscriber source row %s -> new subscriber %s",
+                    row,
+                    new_sub_row,
+                )
+            buffer.write(_copy_text_row(new_sub_row))
+
+        buffer.seek(0)
+        pg_cursor.copy_expert(
+            """
+            COPY subscribers_import("imsi", "data_balance", "balance", "currency", "bridged")
+            FROM STDIN
+            """,
+            buffer,
+        )
+        row_count += len(rows)
 
-        try:
-            pg_cursor.execute("BEGIN TRANSACTION")
-            pg_cursor.execute(
-                """
-                INSERT INTO subscribers("imsi", "data_balance", "balance", "currency", "bridged")
-                VALUES
-                (%s, %s, %s, %s, %s)""",
-                new_sub_row,
-            )
-            logging.debug(
-                "Migrating customer -> subscriber source row %s -> new subscriber %s",
-                row,
-                new_sub_row,
-            )
-            pg_cursor.execute("COMMIT")
-        except psycopg2.errors.UniqueViolation as e:
-            logging.warning(
-                "Skipping insert subscriber %s due to uniqueness error: %s ",
-                new_sub_row,
-                e,
-            )
-            pg_cursor.execute("ROLLBACK")
+    pg_cursor.execute(
+        """
+        INSERT INTO subscribers("imsi", "data_balance", "balance", "currency", "bridged")
+        SELECT "imsi", "data_balance", "balance", "currency", "bridged"
+        FROM subscribers_import
+        ON CONFLICT ("imsi") DO NOTHING
+        """
+    )
+    if pg_cursor.rowcount != row_count:
+        logging.warning(
+            "Skipped inserting %d subscribers that already exist",
+            row_count - pg_cursor.rowcount,
+        )
 
     mysql_cursor.close()
     mysql_conn.commit()
@@ -141,38 +205,45 @@ def migrate_subscribers(mysql_conn, pg_conn, currency_id):
 
 def migrate_static_ips(mysql_conn, pg_conn):
     mysql_conn.start_transaction(isolation_level="SERIALIZABLE")
-    mysql_cursor = mysql_conn.cursor()
+    # Use an unbuffered cursor so rows are streamed from the server as they
+    # are fetched rather than read into memory all at once.
+    mysql_cursor = mysql_conn.cursor(buffered=False)
     pg_cursor = pg_conn.cursor()
-    pg_cursor.execute("BEGIN TRANSACTION")
 
     mysql_cursor.execute("select imsi, ip from static_ips;")
-    for row in mysql_cursor:
-        imsi = row[0]
-        ip = row[1]
+    log_rows = logging.getLogger().isEnabledFor(logging.DEBUG)
+    row_count = 0
+    inserted_count = 0
+    for rows in _fetch_batches(mysql_cursor):
+        if log_rows:
+            for row in rows:
+                logging.debug(
+                    "Migrating static ip %s and imsi %s",
+                    row[1],
+                    row[0],
+                )
+
+        # Insert each batch as a single multi-row insert, skipping any that
+        # would conflict with an existing static ip. With one page per batch
+        # the cursor rowcount covers the whole batch.
+        psycopg2.extras.execute_values(
+            pg_cursor,
+            """
+            INSERT INTO static_ips("imsi", "ip")
+            VALUES %s
+            ON CONFLICT DO NOTHING
+            """,
+            rows,
+            page_size=MIGRATION_BATCH_SIZE,
+        )
+        row_count += len(rows)
+        inserted_count += pg_cursor.rowcount
 
-        try:
-            pg_cursor.execute("BEGIN TRANSACTION")
-            pg_cursor.execute(
-                """
-                INSERT INTO static_ips("imsi", "ip")
-                VALUES
-                (%s, %s)""",
-                [imsi, ip],
-            )
-            logging.debug(
-                "Migrating static ip %s and imsi %s",
-                ip,
-                imsi,
-            )
-            pg_cursor.execute("COMMIT")
-        except psycopg2.errors.UniqueViolation as e:
-            logging.warning(
-                "Skipping insert static ip %s for imsi %s due to uniqueness error: %s",
-                ip,
-                imsi,
-                e,
-            )
-            pg_cursor.execute("ROLLBACK")
+    if inserted_count != row_count:
+        logging.warning(
+            "Skipped inserting %d static ips that conflict with existing static ips",
+            row_count - inserted_count,
+        )
 
     mysql_cursor.close()
     mysql_conn.commit()
@@ -214,9 +285,20 @@ if __name__ == "__main__":
         default=Path("/etc/haulage/config.yml"),
         help="The location of a haulage config file (version 1)",
     )
+    parser.add_argument(
+        "-v",
+        "--verbose",
+        action="store_true",
+        help="Log each migrated row",
+    )
 
     args = parser.parse_args()
 
+    if args.verbose:
+        logging.basicConfig(level=logging.DEBUG)
+    else:
+        logging.basicConfig(level=logging.INFO)
+
     (config_db_name, config_db_user, config_db_pass) = read_haulage_config(args.config)
 
     pg_name = config_db_name
@@ -248,3 +330,8 @@ if __name__ == "__main__":
     )
     migrate_subscribers(mysql_connection, pg_connection, legacy_currency_id)
     migrate_static_ips(mysql_connection, pg_connection)
+
+    # Commit the whole migration at once, so a failure part way through
+    # leaves the postgres database untouched.
+    pg_connection.commit()
+    logging.info("Migration complete!")